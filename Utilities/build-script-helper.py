@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 """
  This source file is part of the Swift.org open source project
@@ -12,19 +12,21 @@
  -------------------------------------------------------------------------
 """
 
-from __future__ import print_function
-
 import argparse
+import functools
+import hashlib
 import json
 import os
 import platform
-import re
+import shlex
 import shutil
 import subprocess
-import subprocess
 import sys
 import errno
 
+IS_DARWIN = platform.system() == 'Darwin'
+IS_LINUX = platform.system() == 'Linux'
+
 def note(message):
     print("--- %s: note: %s" % (os.path.basename(sys.argv[0]), message))
     sys.stdout.flush()
@@ -43,11 +45,49 @@ def mkdir_p(path):
         if e.errno != errno.EEXIST:
             raise
 
+def read_file(path):
+    """Returns the contents of the given file, or None if it cannot be read."""
+    try:
+        with open(path) as f:
+            return f.read()
+    except IOError:
+        return None
+
+def parallel_rmtree(path):
+    """Removes the given directory tree, deleting its top-level entries in parallel."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Like `rm -rf`, only remove a symlink itself, never the tree it points to.
+    if os.path.islink(path) or os.path.isfile(path):
+        os.unlink(path)
+        return
+    if not os.path.isdir(path):
+        return
+
+    with ThreadPoolExecutor(max_workers=min(8, get_cpu_count())) as executor:
+        futures = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    futures.append(executor.submit(shutil.rmtree, entry.path))
+                else:
+                    os.unlink(entry.path)
+        for future in futures:
+            future.result()
+    os.rmdir(path)
+
+def write_file(path, contents):
+    """Writes the given contents to the given file."""
+    with open(path, "w") as f:
+        f.write(contents)
+
 def call(cmd, cwd=None, verbose=False):
     """Calls a subprocess."""
     if verbose:
         print(' '.join(cmd))
     try:
+        # Flush so the command shows up in the logs before the subprocess output.
+        sys.stdout.flush()
         subprocess.check_call(cmd, cwd=cwd)
     except Exception as e:
         if not verbose:
@@ -65,6 +105,27 @@ def call_output(cmd, cwd=None, stderr=False, verbose=False):
             print(' '.join(cmd))
         error(str(e))
 
+def get_cpu_count():
+    """Returns the number of CPUs the process is allowed to run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def get_job_count():
+    """Returns the number of parallel jobs to run, honoring NINJAJOBS or JOBS if set."""
+    for name in ["NINJAJOBS", "JOBS"]:
+        jobs = os.getenv(name)
+        if jobs:
+            try:
+                count = int(jobs)
+            except ValueError:
+                count = 0
+            # Ninja treats 0 as unlimited parallelism, which is the opposite of what an override is for.
+            if count < 1:
+                error("%s must be a positive integer, got '%s'" % (name, jobs))
+            return count
+    return get_cpu_count()
+
 def main():
     parser = argparse.ArgumentParser(description="""
         This script will build a TSC using CMake.
@@ -76,8 +137,13 @@ def main():
     parser_build.set_defaults(func=build)
     add_build_args(parser_build)
 
-    args = parser.parse_args()
-    args.func = args.func or build
+    # clean
+    parser_clean = subparsers.add_parser("clean", help="cleans build artifacts")
+    parser_clean.set_defaults(func=clean)
+    add_global_args(parser_clean)
+
+    # Default to building when no action is given.
+    args = parser.parse_args(sys.argv[1:] or ["build"])
     args.func(args)
 
 # -----------------------------------------------------------
@@ -95,14 +161,19 @@ def add_global_args(parser):
         "-v", "--verbose",
         action="store_true",
         help="whether to print verbose output")
-    parser.add_argument(
-        "--reconfigure",
-        action="store_true",
-        help="whether to always reconfigure cmake")
 
 def add_build_args(parser):
     """Configures the parser with the arguments necessary for build-related actions."""
     add_global_args(parser)
+    parser.add_argument(
+        "--reconfigure",
+        action="store_true",
+        help="whether to always reconfigure cmake")
+    parser.add_argument(
+        "--cache-dir",
+        help="path where data persisted across builds is stored [%(default)s]",
+        default=get_default_cache_dir(),
+        metavar="PATH")
     parser.add_argument(
         "--swiftc-path",
         help="path to the swift compiler",
@@ -121,18 +192,33 @@ def parse_global_args(args):
     args.build_dir = os.path.abspath(args.build_dir)
     args.project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
-    if platform.system() == 'Darwin':
-        args.sysroot = call_output(["xcrun", "--sdk", "macosx", "--show-sdk-path"], verbose=args.verbose)
-    else:
-        args.sysroot = None
-
 def parse_build_args(args):
     """Parses and cleans arguments necessary for build-related actions."""
     parse_global_args(args)
 
+    args.cache_dir = os.path.abspath(args.cache_dir)
+
+    args.sysroot = get_sysroot(args)
     args.swiftc_path = get_swiftc_path(args)
     args.cmake_path = get_cmake_path(args)
     args.ninja_path = get_ninja_path(args)
+    args.swift_flags = get_swift_flags(args)
+
+def get_sysroot(args):
+    """Returns the path to the SDK to build against, if any."""
+    if IS_DARWIN:
+        return find_default_sysroot(args)
+    else:
+        return None
+
+def get_swift_flags(args):
+    """Returns the flags to pass to the Swift compiler."""
+    # CMAKE_Swift_FLAGS ends up verbatim in the shell commands run by Ninja, so paths need to be shell-quoted.
+    # Keep the module cache outside of the build directory so it survives cleans.
+    swift_flags = "-module-cache-path %s" % shlex.quote(os.path.join(args.cache_dir, "ModuleCache"))
+    if args.sysroot:
+        swift_flags += " -sdk %s" % shlex.quote(args.sysroot)
+    return swift_flags
 
 def get_swiftc_path(args):
     """Returns the path to the Swift compiler."""
@@ -140,14 +226,8 @@ def get_swiftc_path(args):
         swiftc_path = os.path.abspath(args.swiftc_path)
     elif os.getenv("SWIFT_EXEC"):
         swiftc_path = os.path.realpath(os.getenv("SWIFT_EXEC"))
-    elif platform.system() == 'Darwin':
-        swiftc_path = call_output(
-            ["xcrun", "--find", "swiftc"],
-            stderr=subprocess.PIPE,
-            verbose=args.verbose
-        )
     else:
-        swiftc_path = call_output(["which", "swiftc"], verbose=args.verbose)
+        swiftc_path = find_tool(args, "swiftc")
 
     if os.path.basename(swiftc_path) == 'swift':
         swiftc_path = swiftc_path + 'c'
@@ -158,34 +238,105 @@ def get_cmake_path(args):
     """Returns the path to CMake."""
     if args.cmake_path:
         return os.path.abspath(args.cmake_path)
-    elif platform.system() == 'Darwin':
-        return call_output(
-            ["xcrun", "--find", "cmake"],
-            stderr=subprocess.PIPE,
-            verbose=args.verbose
-        )
     else:
-        return call_output(["which", "cmake"], verbose=args.verbose)
+        return find_tool(args, "cmake")
 
 def get_ninja_path(args):
     """Returns the path to Ninja."""
     if args.ninja_path:
         return os.path.abspath(args.ninja_path)
-    elif platform.system() == 'Darwin':
-        return call_output(
-            ["xcrun", "--find", "ninja"],
-            stderr=subprocess.PIPE,
-            verbose=args.verbose
+    else:
+        return find_tool(args, "ninja")
+
+# -----------------------------------------------------------
+# Toolchain lookup
+# -----------------------------------------------------------
+
+def get_default_cache_dir():
+    """Returns the default directory where data is persisted across invocations."""
+    cache_home = os.getenv("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "swift-tools-support-core")
+
+def disk_cached(func):
+    """
+    Caches the paths returned by a toolchain lookup function on disk, so that subsequent invocations do not need to
+    spawn a subprocess. The cache is invalidated when the environment the lookup depends on changes, or when a cached
+    path no longer exists.
+    """
+    @functools.wraps(func)
+    def wrapper(args, *params):
+        cache_path = os.path.join(args.cache_dir, "toolchain.json")
+        environment = (
+            platform.platform(),
+            os.getenv("PATH"),
+            os.getenv("DEVELOPER_DIR"),
+            os.getenv("TOOLCHAINS"),
+            os.getenv("SDKROOT"),
+            # The developer directory selected with `xcode-select -s`.
+            os.path.realpath("/var/db/xcode_select_link") if IS_DARWIN else None,
         )
+        environment_hash = hashlib.sha1(repr(environment).encode("utf-8")).hexdigest()
+        entry = "%s(%s)" % (func.__name__, ", ".join(params))
+
+        try:
+            cache = json.loads(read_file(cache_path) or "{}")
+        except ValueError:
+            cache = {}
+        if cache.get("environment") != environment_hash:
+            cache = {"environment": environment_hash, "values": {}}
+
+        values = cache["values"]
+        if entry in values and os.path.exists(values[entry]):
+            return values[entry]
+
+        values[entry] = func(args, *params)
+        try:
+            mkdir_p(os.path.dirname(cache_path))
+            write_file(cache_path, json.dumps(cache, indent=2, sort_keys=True))
+        except (IOError, OSError):
+            # The cache is only an optimization, so failing to write it is not an error.
+            pass
+        return values[entry]
+    return wrapper
+
+@disk_cached
+def find_default_sysroot(args):
+    """Returns the path to the default macOS SDK."""
+    return call_output(["xcrun", "--sdk", "macosx", "--show-sdk-path"], verbose=args.verbose)
+
+def find_tool(args, name):
+    """Returns the path to the given tool in the active toolchain."""
+    if IS_DARWIN:
+        return find_tool_with_xcrun(args, name)
     else:
-        return call_output(["which", "ninja"], verbose=args.verbose)
+        path = shutil.which(name)
+        if not path:
+            error("unable to find %s in PATH" % name)
+        return path
+
+@disk_cached
+def find_tool_with_xcrun(args, name):
+    """Returns the path to the given tool in the active Xcode toolchain."""
+    return call_output(
+        ["xcrun", "--find", name],
+        stderr=subprocess.PIPE,
+        verbose=args.verbose
+    )
 
 # -----------------------------------------------------------
 # Actions
 # -----------------------------------------------------------
 
+def clean(args):
+    parse_global_args(args)
+    try:
+        parallel_rmtree(args.build_dir)
+    except OSError as e:
+        error("unable to remove %s: %s" % (args.build_dir, e))
+
 def build(args):
     parse_build_args(args)
+    note("using cache directory %s" % args.cache_dir)
     build_tsc(args)
 
 # -----------------------------------------------------------
@@ -194,37 +345,48 @@ def build(args):
 
 def build_with_cmake(args, cmake_args, source_path, build_dir):
     """Runs CMake if needed, then builds with Ninja."""
+    cmd = [
+        args.cmake_path, "-G", "Ninja",
+        "-DCMAKE_MAKE_PROGRAM=%s" % args.ninja_path,
+        "-DCMAKE_BUILD_TYPE:=Debug",
+        "-DCMAKE_Swift_FLAGS=" + args.swift_flags,
+        "-DCMAKE_Swift_COMPILER:=%s" % (args.swiftc_path),
+        # Link steps are memory-heavy, so cap how many run in parallel. Compile parallelism is left to `ninja -j`, which
+        # keeps the job count out of the CMake invocation so changing it does not force a reconfigure.
+        "-DCMAKE_JOB_POOLS:STRING=link=2",
+        "-DCMAKE_JOB_POOL_LINK:STRING=link",
+        "-DCMAKE_EXPORT_COMPILE_COMMANDS:BOOL=ON",
+    ] + cmake_args + [source_path]
+
+    # Only rerun CMake when the invocation changed since the last successful configure;
+    # Ninja takes care of regenerating the build files for changes to the CMake sources.
     cache_path = os.path.join(build_dir, "CMakeCache.txt")
-    if args.reconfigure or not os.path.isfile(cache_path) or not args.swiftc_path in open(cache_path).read():
-        swift_flags = ""
-        if args.sysroot:
-            swift_flags = "-sdk %s" % args.sysroot
-
-        cmd = [
-            args.cmake_path, "-G", "Ninja",
-            "-DCMAKE_MAKE_PROGRAM=%s" % args.ninja_path,
-            "-DCMAKE_BUILD_TYPE:=Debug",
-            "-DCMAKE_Swift_FLAGS=" + swift_flags,
-            "-DCMAKE_Swift_COMPILER:=%s" % (args.swiftc_path),
-        ] + cmake_args + [source_path]
-
+    hash_path = os.path.join(build_dir, ".cmake_invocation_hash")
+    cmd_hash = hashlib.sha1(repr(cmd).encode("utf-8")).hexdigest()
+    if args.reconfigure or not os.path.isfile(cache_path) or read_file(hash_path) != cmd_hash:
         if args.verbose:
             print(' '.join(cmd))
 
         mkdir_p(build_dir)
         call(cmd, cwd=build_dir, verbose=True)
+        write_file(hash_path, cmd_hash)
 
     # Build.
-    ninja_cmd = [args.ninja_path]
+    jobs = get_job_count()
+    ninja_cmd = [args.ninja_path, "-j", str(jobs)]
+
+    # The load average is host-wide, so cap it by the host's CPU count rather than the affinity-restricted job count.
+    if IS_LINUX:
+        ninja_cmd.extend(["-l", str(os.cpu_count() or jobs)])
 
     if args.verbose:
-        ninja_cmd.append("-v")
+        ninja_cmd.extend(["-v", "-d", "explain", "-d", "keepdepfile", "-d", "keeprsp"])
 
     call(ninja_cmd, cwd=build_dir, verbose=args.verbose)
 
 def build_tsc(args):
     cmake_flags = []
-    if platform.system() == 'Darwin':
+    if IS_DARWIN:
         cmake_flags.append("-DCMAKE_C_FLAGS=-target x86_64-apple-macosx10.10")
         cmake_flags.append("-DCMAKE_OSX_DEPLOYMENT_TARGET=10.10")
 